@@ -1,10 +1,12 @@
-import os, re, zipfile, unicodedata
+import os, re, json, hashlib, zipfile, threading, weakref, unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from datetime import datetime
 from dotenv import load_dotenv
 
 
 import boto3
+from botocore.config import Config
 import streamlit as st
 from docx import Document
 from docx.shared import Pt, RGBColor, Cm, Mm
@@ -29,12 +31,18 @@ def set_cell_vertical(cell, dir="btLr"):
     tcPr.append(td)
 
 # ── AWS / ENV ───────────────────────────────────────────────────────────────
+# All retrying of throttling / 5xx / connection errors happens here, per
+# Textract call, so a throttled page is retried alone instead of re-OCR'ing
+# the whole file. The batch loop below only isolates failures per file.
+AWS_MAX_ATTEMPTS = 5
+
 load_dotenv()
 textract = boto3.client(
     "textract",
     aws_access_key_id     = os.getenv("AWS_ACCESS_KEY_ID"),
     aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name           = os.getenv("AWS_REGION") or "us-east-2"
+    region_name           = os.getenv("AWS_REGION") or "us-east-2",
+    config                = Config(retries={"max_attempts": AWS_MAX_ATTEMPTS, "mode": "standard"})
 )
 
 # ── STREAMLIT UI ────────────────────────────────────────────────────────────
@@ -69,15 +77,65 @@ def correct_orientation(img: Image.Image) -> Image.Image:
         return img.rotate(-90, expand=True)
     return img
 
-def get_textract_blocks(uploaded_file):
+# ── HELPER: OCR QUALITY CHECK (adaptive DPI) ────────────────────────────────
+# Rasterized pages are OCR'd at the cheapest DPI first and only re-rendered
+# at the next step when the result looks poor (300 was the old fixed value).
+OCR_DPI_STEPS       = (150, 200, 300)
+MIN_WORD_CONFIDENCE = 85.0   # mean Textract CONFIDENCE over the page's WORDs
+FAMILY_TABLE_COLS   = 13     # N. … Numero Personale on the Albanian form
+
+def page_ocr_score(page_blocks, page_no):
+    """
+    (passed, mean WORD confidence) for one page's OCR; tuples compare
+    pass/fail first, so max() picks the best attempt across DPI steps.
+    Passing means mean confidence above the threshold and, on page 2,
+    a family table with all columns and a Numero Personale per person.
+    A page with no WORDs at all (blank back side, separator) passes as
+    is – a higher DPI won't find text that isn't there.
+    """
+    confs = [b.get("Confidence", 0.0) for b in page_blocks if b["BlockType"] == "WORD"]
+    if not confs:
+        return (True, 0.0)
+    mean_conf = sum(confs) / len(confs)
+    if mean_conf < MIN_WORD_CONFIDENCE:
+        return (False, mean_conf)
+
+    if page_no != 2:
+        return (True, mean_conf)
+
+    tbl = next((b for b in page_blocks if b["BlockType"] == "TABLE"), None)
+    if not tbl:
+        return (False, mean_conf)
+    rows_map = table_rows_map(tbl, {b["Id"]: b for b in page_blocks})
+    max_col = max((c for row in rows_map.values() for c in row.keys()), default=0)
+    if max_col < FAMILY_TABLE_COLS:
+        return (False, mean_conf)
+
+    # data rows 3–12: every row with a name must carry a Numero Personale
+    people = [rows_map.get(r, {}) for r in range(3, 13) if rows_map.get(r, {}).get(2)]
+    return (bool(people) and all(row.get(FAMILY_TABLE_COLS) for row in people), mean_conf)
+
+def to_png_bytes(img: Image.Image) -> bytes:
+    fixed = correct_orientation(img)
+    buf = BytesIO()
+    fixed.save(buf, format="PNG")
+    return buf.getvalue()
+
+class OCRCancelled(Exception):
+    pass
+
+def get_textract_blocks(uploaded_file, should_stop=None):
     from botocore.exceptions import ClientError
     from pdf2image import convert_from_bytes
     from io import BytesIO
 
-    data = uploaded_file.read()
+    data = uploaded_file.getvalue()   # not read(): retries/resumes need the bytes again
     name = uploaded_file.name.lower()
 
     def analyze_bytes(bts, page_no=None):
+        # checked before every call so a cancelled prefetch stops spending quota
+        if should_stop and should_stop():
+            raise OCRCancelled(uploaded_file.name)
         blocks = textract.analyze_document(
             Document={'Bytes': bts},
             FeatureTypes=["TABLES", "FORMS"]
@@ -94,26 +152,30 @@ def get_textract_blocks(uploaded_file):
             return analyze_bytes(data)
         except ClientError as e:
             if "UnsupportedDocumentException" in str(e):
-                # Fallback → image conversion + orientation fix
+                # Fallback → image conversion + orientation fix,
+                # escalating DPI only for pages that fail the quality check
                 all_blocks = []
-                pages = convert_from_bytes(data, dpi=300)
+                pages = convert_from_bytes(data, dpi=OCR_DPI_STEPS[0])
                 for idx, pil_img in enumerate(pages, start=1):
-                    fixed = correct_orientation(pil_img)
-                    buf = BytesIO()
-                    fixed.save(buf, format="PNG")
-                    buf.seek(0)
-                    all_blocks.extend(analyze_bytes(buf.getvalue(), page_no=idx))
+                    page_blocks = analyze_bytes(to_png_bytes(pil_img), page_no=idx)
+                    best = (page_ocr_score(page_blocks, idx), page_blocks)
+                    for dpi in OCR_DPI_STEPS[1:]:
+                        if best[0][0]:
+                            break
+                        hi_res = convert_from_bytes(data, dpi=dpi,
+                                                    first_page=idx, last_page=idx)[0]
+                        page_blocks = analyze_bytes(to_png_bytes(hi_res), page_no=idx)
+                        # keep the best attempt, not the last: more DPI can score worse
+                        best = max(best, (page_ocr_score(page_blocks, idx), page_blocks),
+                                   key=lambda attempt: attempt[0])
+                    all_blocks.extend(best[1])
                 return all_blocks
             else:
                 raise
 
     # Image path (JPG/PNG etc)
     img = Image.open(BytesIO(data))
-    fixed = correct_orientation(img)
-    buf = BytesIO()
-    fixed.save(buf, format="PNG")
-    buf.seek(0)
-    return analyze_bytes(buf.getvalue(), page_no=1)
+    return analyze_bytes(to_png_bytes(img), page_no=1)
 
 # -- HELPER: translator
 
@@ -325,16 +387,8 @@ def extract_seal_footer(blocks):
 
 
 # ── TABLE-FIELD EXTRACTION ON PAGE 2 ────────────────────────────────────────
-def extract_family_table_v2(blocks, bmap):
-    import re
-
-    # 1) find the TABLE on page 2
-    tbl = next((b for b in blocks
-                if b["BlockType"] == "TABLE" and b.get("Page") == 2), None)
-    if not tbl:
-        return {"header": [], "rows": [], "seal_footer": ""}
-
-    # 2) build a map: rows_map[row_index][col_index] = cell_text
+def table_rows_map(tbl, bmap):
+    """rows_map[row_index][col_index] = cell_text for one Textract TABLE."""
     rows_map = {}
     for rel in tbl.get("Relationships", []):
         if rel["Type"] != "CHILD":
@@ -352,6 +406,19 @@ def extract_family_table_v2(blocks, bmap):
                 if bmap[wid]["BlockType"] == "WORD"
             ).strip()
             rows_map.setdefault(r, {})[c] = txt
+    return rows_map
+
+def extract_family_table_v2(blocks, bmap):
+    import re
+
+    # 1) find the TABLE on page 2
+    tbl = next((b for b in blocks
+                if b["BlockType"] == "TABLE" and b.get("Page") == 2), None)
+    if not tbl:
+        return {"header": [], "rows": [], "seal_footer": ""}
+
+    # 2) build a map: rows_map[row_index][col_index] = cell_text
+    rows_map = table_rows_map(tbl, bmap)
 
     # 3) extract header row (row 1)
     max_col = max((c for row in rows_map.values() for c in row.keys()), default=0)
@@ -418,7 +485,7 @@ def extract_comune_sezione(blocks):
 
 
 # ── DOCX TEMPLATE ───────────────────────────────────────────────────────────
-def make_docx(people, comune, sezione, seal_text):
+def make_docx(people, comune, sezione, seal_text, issue_date=""):
     from docx import Document
     from docx.shared import Pt, RGBColor, Cm, Mm
     from docx.oxml.ns import qn
@@ -667,6 +734,134 @@ def make_docx(people, comune, sezione, seal_text):
     return buf
 
 
+# ── BATCH: per-file stages with checkpoints ─────────────────────────────────
+# Each file runs ocr → extract → docx. Every finished stage is stored in
+# st.session_state["checkpoints"] under the file's content hash, so pressing
+# Translate again after a failure skips the work that already succeeded.
+# Retries live in the Textract client config (see AWS / ENV), not here.
+class StageError(Exception):
+    def __init__(self, stage, cause):
+        super().__init__(f"{stage}: {cause}")
+        self.stage, self.cause = stage, cause
+
+def file_key(uploaded_file):
+    return f"{uploaded_file.name}:{hashlib.sha1(uploaded_file.getvalue()).hexdigest()}"
+
+def run_stage(ckpt, stage, fn, *args):
+    """Return the checkpointed output of `stage`, or run it once and checkpoint it."""
+    if stage in ckpt:
+        return ckpt[stage]
+    try:
+        ckpt[stage] = fn(*args)
+    except Exception as e:
+        raise StageError(stage, e) from e
+    return ckpt[stage]
+
+def extract_fields(blocks):
+    # without the family table the DOCX would be an empty certificate
+    if not any(b["BlockType"] == "TABLE" and b.get("Page") == 2 for b in blocks):
+        raise ValueError("no family table found on page 2")
+    bmap       = {b["Id"]: b for b in blocks}
+    table_data = extract_family_table_v2(blocks, bmap)
+    comune,sez = extract_comune_sezione(blocks)
+    comune,sez = normalize_comune_sezione(comune, sez)
+    return {
+        "people":     exonymize_deep(table_data["rows"]),
+        "comune":     comune,
+        "sezione":    sez,
+        "seal_text":  map_exonyms(extract_seal_footer(blocks)),
+        "issue_date": extract_issue_date(blocks),
+    }
+
+def render_docx(fields):
+    return make_docx(fields["people"], fields["comune"], fields["sezione"],
+                     fields["seal_text"], issue_date=fields["issue_date"]).getvalue()
+
+def process_file(uploaded_file, ckpt):
+    blocks = run_stage(ckpt, "ocr", get_textract_blocks, uploaded_file)
+    fields = run_stage(ckpt, "extract", extract_fields, blocks)
+    return run_stage(ckpt, "docx", render_docx, fields)
+
+
+# ── PREFETCH: speculative OCR right after upload (opt-in) ──────────────────
+# While the user is still on the page, uploaded files are OCR'd in background
+# threads so Translate only has to run extract → docx. Jobs are keyed like the
+# checkpoints and cancelled as soon as their file leaves the uploader.
+MAX_PREFETCH_FILES = 10
+PREFETCH_WORKERS   = 2
+
+def _shutdown_prefetch(pool, jobs):
+    for fut, stop in jobs.values():
+        stop.set()
+        fut.cancel()
+    jobs.clear()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+class PrefetchStore:
+    """
+    Session-scoped background OCR jobs: key -> (future, stop event).
+    Finished jobs, failed ones included, stay in the store until Translate
+    takes them or their file leaves the uploader, so reruns don't resubmit
+    them. The pool is shut down when no jobs are left or the session's
+    store is garbage-collected.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.jobs = {}
+
+    def submit(self, key, uploaded_file):
+        if key in self.jobs or len(self.jobs) >= MAX_PREFETCH_FILES:
+            return   # already running/finished, or over budget: Translate will OCR it
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+            self._finalizer = weakref.finalize(self, _shutdown_prefetch, self.pool, self.jobs)
+        stop = threading.Event()
+        fut  = self.pool.submit(get_textract_blocks, uploaded_file, stop.is_set)
+        self.jobs[key] = (fut, stop)
+
+    def cancel(self, key):
+        fut, stop = self.jobs.pop(key)
+        stop.set()      # running job: stops before its next Textract call
+        fut.cancel()    # queued job: never starts
+
+    def retain(self, keys):
+        for k in [k for k in self.jobs if k not in keys]:
+            self.cancel(k)
+        if not self.jobs and self.pool is not None:
+            self._finalizer()   # runs _shutdown_prefetch once
+            self.pool = None
+
+    def take(self, key):
+        """
+        Wait for and hand over prefetched blocks; None if there is no job.
+        A failed job is dropped and raised as StageError, so the file is
+        reported once and the next run OCRs it afresh, as without prefetch.
+        """
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return None
+        try:
+            return job[0].result()
+        except Exception as e:
+            raise StageError("ocr", e) from e
+
+
+prefetch_on = st.checkbox("Start OCR as soon as files are uploaded", value=False)
+if "prefetch" not in st.session_state:
+    st.session_state["prefetch"] = PrefetchStore()
+prefetch = st.session_state["prefetch"]
+if prefetch_on and uploaded_files:
+    upload_keys = {file_key(f): f for f in uploaded_files}
+    prefetch.retain(upload_keys)
+    checkpoints = st.session_state.get("checkpoints", {})
+    for k, f in upload_keys.items():
+        if "ocr" not in checkpoints.get(k, {}):
+            prefetch.submit(k, f)
+else:
+    prefetch.retain(set())
+
+
 # ── MAIN FLOW ───────────────────────────────────────────────────────────────
 if uploaded_files and st.button("Translate"):
     single = len(uploaded_files)==1
@@ -675,37 +870,49 @@ if uploaded_files and st.button("Translate"):
     else:
         files = uploaded_files
 
+    # keep checkpoints only for files that are still uploaded
+    keys = [file_key(f) for f in files]
+    checkpoints = st.session_state.setdefault("checkpoints", {})
+    for k in set(checkpoints) - set(keys):
+        del checkpoints[k]
+
     zip_buf = BytesIO() if not single else None
     if not single:
         zipf = zipfile.ZipFile(zip_buf, "w")
 
-    for f in files:
+    done, errors = [], []
+    for f, key in zip(files, keys):
+        ckpt = checkpoints.setdefault(key, {})
         with st.spinner(f"Processing {f.name}..."):
-            blocks = get_textract_blocks(f)
-            bmap   = {b["Id"]: b for b in blocks}
-            table_data = extract_family_table_v2(blocks, bmap)
-            seal_text = extract_seal_footer(blocks)
-            headers    = table_data["header"]   # if you need to render them dynamically
-            people     = table_data["rows"]
-            comune,sez = extract_comune_sezione(blocks)
-            seal   = extract_seal_footer(blocks)
-            issue_date = extract_issue_date(blocks)
-            people     = exonymize_deep(people)
-            comune,sez = normalize_comune_sezione(comune, sez)
-            seal_text  = map_exonyms(seal_text)  
-            docx_b = make_docx(people, comune, sez, seal_text)
+            try:
+                if "ocr" not in ckpt:
+                    blocks = prefetch.take(key)
+                    if blocks is not None:
+                        ckpt["ocr"] = blocks
+                docx_b = process_file(f, ckpt)
+            except StageError as e:
+                errors.append({"file": f.name, "stage": e.stage, "error": repr(e.cause)})
+                st.error(f"{f.name}: failed during {e.stage} – {e.cause}")
+                continue
+        done.append(f.name)
 
         if single:
             name = f"Certificato_di_Famiglia_{datetime.today():%d-%m-%Y}.docx"
-            st.download_button("📥 Download DOCX", docx_b.getvalue(), file_name=name,
+            st.download_button("📥 Download DOCX", docx_b, file_name=name,
                                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
         else:
             out_name = f"{os.path.splitext(f.name)[0]}_{datetime.today():%d-%m-%Y}.docx"
-            zipf.writestr(out_name, docx_b.getvalue())
+            zipf.writestr(out_name, docx_b)
 
     if not single:
+        zipf.writestr("error_manifest.json",
+                      json.dumps({"completed": done, "failed": errors},
+                                 ensure_ascii=False, indent=2))
         zipf.close()
         zip_buf.seek(0)
+        if errors:
+            st.warning(f"{len(errors)} of {len(files)} file(s) failed – see error_manifest.json. "
+                       "Press Translate again to retry them; finished files are not redone.")
         st.download_button("📥 Download All Translations (ZIP)", zip_buf,
                            file_name=f"certificati_tradotti_{datetime.today():%Y-%m-%d}.zip",
                            mime="application/zip")